@@ -0,0 +1,191 @@
+import base64
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+import requests
+from PIL import Image
+
+jpeg_signature = b'\xff\xd8\xff'
+max_download_size = 50 * 1048576  # Images bigger than this are refused rather than held in memory
+
+
+def downloadImage(image_url, proxies=None, cancel=None):  # Returns the bytes at image_url, raising if the request fails or the file is too big.  Returns None if the cancel event gets set
+    r = requests.get(image_url, stream=True, proxies=proxies)
+    r.raw.decode_content = True  # handle spurious Content-Encoding
+    r.raise_for_status()
+    if int(r.headers.get('Content-Length', None) or 0) > max_download_size:
+        r.close()
+        raise ValueError("Image at " + image_url + " is larger than " + str(max_download_size) + " bytes")
+    buffered = BytesIO()
+    for chunk in r.iter_content(65536):
+        if cancel is not None and cancel.is_set():
+            r.close()
+            return None
+        buffered.write(chunk)
+        if buffered.tell() > max_download_size:
+            r.close()
+            raise ValueError("Image at " + image_url + " is larger than " + str(max_download_size) + " bytes")
+    return buffered.getvalue()
+
+
+def toJpeg(data, max_dimension=0, quality=75):  # Returns data as a JPEG no larger than max_dimension on its longest side (0 for any size).  JPEGs that already fit are returned untouched
+    image = Image.open(BytesIO(data))  # Only reads the header; pixels are decoded when needed
+    fits = not max_dimension or max(image.size) <= max_dimension
+    if image.format == 'JPEG' and data.startswith(jpeg_signature) and fits:
+        return data
+
+    if not fits:
+        scale = max_dimension / max(image.size)
+        image.draft('RGB', (int(image.size[0] * scale), int(image.size[1] * scale)))  # JPEGs decode straight to a smaller size, which is much quicker than decoding everything and resizing
+    if image.mode == 'P' and 'transparency' in image.info:
+        image = image.convert('RGBA')
+    elif image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'CMYK'):
+        image = image.convert('RGB')
+    if not fits:  # Scale down before filling in transparency, so there are fewer pixels to fill
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS, reducing_gap=2.0)
+    if image.mode in ('RGBA', 'LA'):
+        fill_color = 'black'  # your background
+        background = Image.new(image.mode[:-1], image.size, fill_color)
+        background.paste(image, image.split()[-1])
+        image = background
+
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+class image_cache:  # Finished JPEGs on disk, stored once per distinct content (named by its SHA-256) and looked up by where they came from.  Least recently used images are deleted once the cache is bigger than max_size bytes
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path / 'index.sqlite'), check_same_thread=False, isolation_level=None, timeout=30)  # The scrapers can share one cache, even while running at the same time
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, hash TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS sources_hash ON sources (hash)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS images (hash TEXT PRIMARY KEY, size INTEGER, used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS images_used ON images (used)")
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    @staticmethod
+    def source(image_url, max_dimension, quality):  # The same URL gives different bytes at different settings
+        return "{} {} {}".format(max_dimension, quality, image_url)
+
+    def imagePath(self, image_hash):
+        return self.path / image_hash[:2] / (image_hash + '.jpg')
+
+    def get(self, source):  # Returns the JPEG bytes cached for source, or None
+        with self.lock:
+            row = self.connection.execute("SELECT hash FROM sources WHERE source = ?", (source,)).fetchone()
+            if row is not None:
+                try:
+                    image = self.imagePath(row[0]).read_bytes()
+                    self.connection.execute("UPDATE images SET used = ? WHERE hash = ?", (time.time(), row[0]))
+                    self.hits = self.hits + 1
+                    return image
+                except OSError:  # Deleted behind our back
+                    self.connection.execute("DELETE FROM sources WHERE hash = ?", (row[0],))
+                    self.connection.execute("DELETE FROM images WHERE hash = ?", (row[0],))
+            self.misses = self.misses + 1
+        return None
+
+    def put(self, source, image):
+        image_hash = hashlib.sha256(image).hexdigest()
+        image_path = self.imagePath(image_hash)
+        with self.lock:
+            if not image_path.is_file():
+                image_path.parent.mkdir(exist_ok=True)
+                temporary_path = image_path.with_suffix('.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp')
+                temporary_path.write_bytes(image)
+                os.replace(str(temporary_path), str(image_path))  # Readers never see half an image
+            self.connection.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?)", (image_hash, len(image), time.time()))
+            self.connection.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", (source, image_hash))
+            total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+            while total > self.max_size:  # Drop least recently used images until we're under the cap
+                rows = self.connection.execute("SELECT hash, size FROM images ORDER BY used LIMIT 100").fetchall()
+                if not rows:
+                    break
+                for row_hash, size in rows:
+                    self.connection.execute("DELETE FROM sources WHERE hash = ?", (row_hash,))
+                    self.connection.execute("DELETE FROM images WHERE hash = ?", (row_hash,))
+                    try:
+                        self.imagePath(row_hash).unlink()
+                    except OSError:
+                        pass
+                    self.evicted = self.evicted + 1
+                    total = total - size
+                    if total <= self.max_size:
+                        break
+
+    def printStats(self):
+        with self.lock:
+            images, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images").fetchone()
+            sources = self.connection.execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+        print("Image cache: {} hits, {} misses, {} evicted; {} images for {} URLs, {:.1f} MB of {:.1f} MB".format(self.hits, self.misses, self.evicted, images, sources, size / 1048576, self.max_size / 1048576))
+
+
+default_cache_path = Path(__file__).with_name('image_cache')  # Shared by all the scrapers
+
+
+def getJpegImage(image_url, proxies=None, max_dimension=0, quality=75, cancel=None, cache=None):  # Downloads an image and returns it as JPEG bytes, or gets it from cache if given.  Raises on any failure
+    if cache is not None:
+        image = cache.get(cache.source(image_url, max_dimension, quality))
+        if image is not None:
+            return image
+    data = downloadImage(image_url, proxies, cancel)
+    if data is None:
+        return None
+    image = toJpeg(data, max_dimension, quality)
+    if cache is not None:
+        cache.put(cache.source(image_url, max_dimension, quality), image)
+    return image
+
+
+def getBabepediaImage(name, proxies=None, max_dimension=0, quality=75, cancel=None, cache=None):  # Returns Babepedia's picture of a performer as JPEG bytes, or None if they don't have one
+    url = "https://www.babepedia.com/pics/" + urllib.parse.quote(name) + ".jpg"
+    try:
+        return getJpegImage(url, proxies, max_dimension, quality, cancel, cache)
+    except requests.HTTPError as e:
+        if e.response is not None and 400 <= e.response.status_code < 500:  # No picture under that name
+            return None
+        raise
+
+
+def firstImage(candidates, max_workers=4):  # Tries the candidates (functions taking a cancel event and returning an image, or None if there isn't one) at the same time.  Returns the image from the first candidate in the list that finds one, and cancels the rest.  If none finds one and any of them failed, raises that failure, since "no image" isn't certain
+    cancel = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max(1, min(len(candidates), max_workers)))
+    futures = [executor.submit(candidate, cancel) for candidate in candidates]
+    error = None
+    try:
+        for future in futures:
+            try:
+                image = future.result()
+            except Exception as e:
+                logging.error("Error getting an image", exc_info=logging.getLogger().isEnabledFor(logging.DEBUG))
+                error = error or e
+                continue
+            if image:
+                return image
+        if error is not None:
+            raise error
+        return None
+    finally:
+        cancel.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def imageDataUri(image, header="data:image/jpeg;base64,"):  # Returns JPEG bytes as the data URI Stash expects for images
+    return header + base64.b64encode(image).decode('ascii')
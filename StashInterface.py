@@ -1,16 +1,30 @@
 import argparse
 import base64
+import copy
+import hashlib
+import json
 import logging
 import math
+import os
+import pickle
 import re
 import sys
+import threading
 import time
-from datetime import datetime
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
 
 import requests
-from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
+try:  # Optional; lets waitForIdle be told when Stash's job queue changes instead of polling it
+    import websocket
+except ImportError:
+    websocket = None
+
 
 # Utility Functions
 def lreplace(pattern, sub, string):
@@ -20,17 +34,54 @@ def lreplace(pattern, sub, string):
     return re.sub('^%s' % pattern, sub, string)
 
 
+def requiredText(pattern):  # Returns text every match of the regex pattern must contain (the longest such run we can tell), or '' if we can't tell
+    if re.search(r'(?<!\\)\|', pattern):  # Alternatives don't share any required text
+        return ''
+    tokens = re.findall(r'\\.|\[(?:\\.|[^\]])*\]|\((?:\\.|[^)])*\)|\{[^}]*\}\??|[?*+]\??|.', pattern, re.DOTALL)
+    runs = [[]]
+    for token in tokens:
+        if token[0] in '?*+{':  # A quantifier; the previous token may repeat or be missing, so it ends the run
+            if runs[-1] and (token[0] in '?*' or token.startswith('{0') or token.startswith('{,')):
+                runs[-1].pop()
+            runs.append([])
+        elif len(token) == 1 and token not in '.^$()[]\\':
+            runs[-1].append(token)
+        elif len(token) == 2 and token[0] == '\\' and not token[1].isalnum():
+            runs[-1].append(token[1])
+        else:
+            runs.append([])
+    return max((''.join(run) for run in runs), key=len)
+
+
+class filename_scrubber:  # Removes release tags (resolution, codec, release group, ...) from file names.  Each word is a regex, removed in order, ignoring case
+    def __init__(self, scrubbed_words, custom_clean_name=None):
+        # Words whose required text isn't in the name can't match, so scrub() skips them without running the regex
+        self.scrubbed_words = [(requiredText(word).casefold(), re.compile(word, re.IGNORECASE)) for word in scrubbed_words]
+        self.custom_clean_name = custom_clean_name  # clean_name from custom.py, which replaces the scrubbing when set
+
+    def scrub(self, file_name):
+        if self.custom_clean_name is not None:
+            return self.custom_clean_name(file_name).strip()
+        clean_name = file_name.replace('.', ' ')  # replace periods
+        folded_name = clean_name.casefold()
+        for required, word in self.scrubbed_words:  # delete scrubbedWords
+            if required in folded_name:
+                scrubbed_name = word.sub('', clean_name)
+                if scrubbed_name != clean_name:
+                    clean_name = scrubbed_name
+                    folded_name = clean_name.casefold()
+        return clean_name.strip()  # trim
+
+
+file_name_scrubber = filename_scrubber([
+    'MP4-(.+?)$', ' XXX ', '1080p', '720p', 'WMV-(.+?)$', '-UNKNOWN', ' x264-(.+?)$', 'DVDRip', 'WEBRIP',
+    'WEB', r'\[PRiVATE\]', 'HEVC', 'x265', 'PRT-xpost', '-xpost', '480p', '2160p', 'SD',
+    'HD', '\'', '&', ' rq'
+])
+
+
 def scrubFileName(file_name):
-    scrubbedWords = [
-        'MP4-(.+?)$', ' XXX ', '1080p', '720p', 'WMV-(.+?)$', '-UNKNOWN', ' x264-(.+?)$', 'DVDRip', 'WEBRIP',
-        'WEB', r'\[PRiVATE\]', 'HEVC', 'x265', 'PRT-xpost', '-xpost', '480p', '2160p', 'SD',
-        'HD', '\'', '&', ' rq'
-    ]
-    clean_name = re.sub(r'\.', ' ', file_name)  # replace periods
-    for word in scrubbedWords:  # delete scrubbedWords
-        clean_name = re.sub(word, '', clean_name, 0, re.IGNORECASE)
-    clean_name = clean_name.strip()  # trim
-    return clean_name
+    return file_name_scrubber.scrub(file_name)
 
 
 def keyIsSet(json_object, fields):  # checks if field exists for json_object.  If "fields" is a list, drills down through a tree defined by the list
@@ -58,11 +109,131 @@ def listToLower(input_list):
     return output_list
 
 
+class scrape_journal:  # Append-only record of what happened to each scene (one JSON object per line), so an interrupted run can pick up where it stopped
+    max_errors = 3  # A scene that failed this many times in a row isn't tried again on resume
+
+    def __init__(self, path, query, stash, resume=False):  # query is anything JSON-serializable describing which scenes this run scrapes
+        self.path = Path(path)
+        self.query = hashlib.sha1(json.dumps(query, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+        self.stash = stash
+        self.lock = threading.Lock()
+        self.outcomes = {}  # scene id -> last outcome journaled for this query since it last started over
+        self.errors = {}  # scene id -> errors in a row
+        self.waiting = []  # (scene id, outcome) held back until Stash has the scene's update
+        self.recorded = 0
+        self.skipped = 0
+        self.compact(resume)
+        self.file = open(str(self.path), 'a', encoding='utf-8')
+        self.write({'event': 'resume' if resume else 'start'})
+        self.started = time.time()
+
+    def compact(self, resume):  # Rewrites the journal with just the latest line for each scene of each query, so it doesn't grow with every run.  Our query's scenes are loaded if resuming, and dropped if not
+        queries = {}  # query -> {scene id: entry}
+        try:
+            with open(str(self.path), encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # Cut short by a crash
+                        continue
+                    if entry.get('event') == 'start':  # A run that didn't resume started this query over
+                        queries[entry.get('query')] = {}
+                    elif 'scene' in entry:
+                        scenes = queries.setdefault(entry.get('query'), {})
+                        previous = scenes.get(entry['scene'], None)
+                        if 'errors' not in entry:  # Errors in a row, carried along in compacted lines
+                            entry['errors'] = (previous['errors'] if previous else 0) + 1 if entry['outcome'] == 'error' else 0
+                        scenes[entry['scene']] = entry
+        except FileNotFoundError:
+            return
+
+        if resume:
+            for scene_id, entry in queries.get(self.query, {}).items():
+                self.outcomes[scene_id] = entry['outcome']
+                self.errors[scene_id] = entry['errors']
+        else:
+            queries.pop(self.query, None)
+        temporary_path = self.path.with_suffix('.tmp')
+        with open(str(temporary_path), 'w', encoding='utf-8') as f:
+            for scenes in queries.values():
+                for entry in scenes.values():
+                    f.write(json.dumps(entry) + '\n')
+        os.replace(str(temporary_path), str(self.path))
+
+    def write(self, entry):
+        entry.update(query=self.query, time=datetime.now().isoformat(timespec='seconds'))
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+
+    def filterSceneIds(self, scene_ids):  # Returns the scene ids the journal doesn't say are done
+        remaining = [scene_id for scene_id in scene_ids if self.outcomes.get(str(scene_id), 'error') == 'error' and self.errors.get(str(scene_id), 0) < self.max_errors]
+        self.skipped = len(scene_ids) - len(remaining)
+        return remaining
+
+    def record(self, scene_id, outcome):  # outcome is e.g. "scraped", "unmatched", "ambiguous" or "error"
+        with self.lock:
+            self.waiting.append((str(scene_id), outcome))
+            with self.stash.scene_update_lock:
+                settled = not self.stash.pending_scene_updates and not self.stash.scene_updates_in_flight  # Everything queued so far has been sent, and Stash has answered
+            if settled:
+                self.commit()
+
+    def commit(self):  # Journals the outcomes we held back, once Stash has taken (or rejected) their updates
+        failed = set(str(scene_id) for scene_id, error in self.stash.failed_scene_updates)
+        for scene_id, outcome in self.waiting:
+            self.write({'scene': scene_id, 'outcome': 'error' if scene_id in failed else outcome})
+            self.recorded = self.recorded + 1
+        self.waiting = []
+
+    def close(self):  # Call after flushSceneUpdates
+        with self.lock:
+            self.commit()
+        self.file.close()
+
+    def printProgress(self):
+        elapsed = time.time() - self.started
+        print("Journal: skipped {} scenes already done, {} scenes in {:.0f}s ({:.1f} scenes/min)".format(self.skipped, self.recorded, elapsed, self.recorded * 60 / elapsed if elapsed else 0))
+
+
+class scene_plan:  # The changes a run would make to Stash, written to a file (one JSON object per line) instead of sent.  stash_interface.applyPlan sends them later
+    def __init__(self, path):
+        self.path = Path(path)
+        self.file = open(str(self.path), 'w', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.counts = {}  # operation -> number planned
+        self.refs = 0
+
+    def write(self, op, data, collection=None):  # Returns a placeholder id for the entity if collection is given, for later changes to refer to until applyPlan creates it
+        with self.lock:
+            entry = {'op': op, 'input': data}
+            if collection:
+                self.refs = self.refs + 1
+                entry['ref'] = "planned:{}:{}".format(collection, self.refs)
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            self.counts[op] = self.counts.get(op, 0) + 1
+            return entry.get('ref', None)
+
+    def close(self):
+        self.file.close()
+
+    def printStats(self):
+        print("Planned {} changes in {}: {}".format(sum(self.counts.values()), self.path, ", ".join("{} {}".format(count, op) for op, count in self.counts.items()) or "nothing to do"))
+
+
+def isPlanned(entity_id):  # True for the placeholder ids handed out while planning
+    return str(entity_id).startswith("planned:")
+
+
 # Stash GraphQL Class
 class stash_interface:
-    performers = []
-    studios = []
-    tags = []
+    _performers = None  # Performers, studios and tags are loaded lazily on first use; see loadCollections
+    performer_name_index = {}  # Lowercase performer name -> performer
+    performer_alias_index = {}  # Lowercase performer name or alias -> performer
+    _studios = None
+    studio_index = {}  # Normalized studio name -> studio
+    _tags = None
+    tag_index = {}  # Normalized tag name or alias -> tag
     server = ""
     username = ""
     password = ""
@@ -71,6 +242,30 @@ class stash_interface:
     auth_token = ""
     proxies = {}
     min_buildtime = datetime(2020, 6, 22)
+    pool_size = 10  # Max number of pooled connections kept open to Stash
+    keep_alive = True  # Set to False to close the connection after every request
+    timeout = (10, 120)  # (connect, read) timeout in seconds for each request to Stash
+    resync_every = 0  # Refetch all performers, studios and tags after this many local cache updates.  0 disables
+    cache_updates = 0
+    startup_time = 0
+    lookup_mode = "auto"  # "local" loads all performers, studios and tags; "server" looks names up in Stash as needed; "auto" picks "server" for collections bigger than server_lookup_threshold
+    server_lookup_threshold = 50000
+    lookup_cache_size = 10000  # Server lookups (including misses) remembered per collection
+    snapshot_dir = Path(__file__).with_name('stash_snapshots')  # Performers, studios and tags are kept here between runs and only refreshed with what changed.  Set to None to always do a full load
+    snapshot_version = 2  # Bump whenever what's indexed changes, so older snapshots are rebuilt
+    snapshot_collections = {  # collection: (all query, find query, find filter argument, find filter type, fields, index attributes)
+        'performers': ('allPerformers', 'findPerformers', 'performer_filter', 'PerformerFilterType', 'id name aliases image_path updated_at', ('performer_name_index', 'performer_alias_index')),
+        'studios': ('allStudios', 'findStudios', 'studio_filter', 'StudioFilterType', 'id name url image_path aliases updated_at', ('studio_index',)),
+        'tags': ('allTags', 'findTags', 'tag_filter', 'TagFilterType', 'id name aliases updated_at', ('tag_index',))
+    }
+    idle_ttl = 10  # Seconds to trust that Stash is idle before checking its job queue again
+    idle_backoff = 2  # Seconds to wait before rechecking a busy job queue.  Doubles on every check, up to idle_backoff_max
+    idle_backoff_max = 60
+    use_job_subscription = False  # If True, wait on Stash's jobsSubscribe subscription (needs websocket-client) to recheck as soon as a job finishes
+    scene_batch_size = 1  # Number of scene updates sent together in one mutation.  1 sends each update immediately
+    scene_batch_seconds = 30  # Pending scene updates are sent once the oldest has waited this long, even if the batch isn't full and nothing else gets queued
+    plan = None  # scene_plan.  When set, creations and updates are written to it instead of sent to Stash
+    plan_batch_size = 200  # Scene updates sent together by applyPlan
 
     headers = {
         "Accept-Encoding": "gzip, deflate, br",
@@ -80,7 +275,7 @@ class stash_interface:
         "DNT": "1"
     }
 
-    def __init__(self, server_url, user="", pword="", ignore_ssl=False, debug=False):
+    def __init__(self, server_url, user="", pword="", ignore_ssl=False, debug=False, pool_size=None, keep_alive=None, timeout=None, scene_batch_size=None, lookup_mode=None):
         self.server = server_url
         self.username = user
         self.password = pword
@@ -88,17 +283,111 @@ class stash_interface:
         if ignore_ssl:
             requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
         self.debug_mode = debug
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if keep_alive is not None:
+            self.keep_alive = keep_alive
+        if timeout is not None:
+            self.timeout = timeout
+        if scene_batch_size is not None:
+            self.scene_batch_size = scene_batch_size
+        if lookup_mode is not None:
+            self.lookup_mode = lookup_mode
+        start = time.perf_counter()
+        self.load_lock = threading.RLock()
+        self.load_times = {}
+        self.lookup_lock = threading.Lock()
+        self.server_lookups = {}  # collection -> whether it's looked up in Stash instead of loaded, once decided
+        self.lookup_cache = {'performers': OrderedDict(), 'studios': OrderedDict(), 'tags': OrderedDict()}
+        self.scene_update_lock = threading.Lock()
+        self.create_lock = threading.RLock()  # Held while checking for and adding a tag, so concurrent callers don't add it twice
+        self.idle_lock = threading.Lock()
+        self.idle_checked = None  # time.monotonic() of the last time we saw an empty job queue
+        self.idle_wait_time = 0  # Total seconds spent waiting for Stash to go idle
+        self.idle_queue_checks = 0
+        self.pending_scene_updates = []
+        self.pending_scene_updates_since = None
+        self.scene_batch_timer = None  # Flushes a batch that's waited scene_batch_seconds, in case the run stalls on a prompt or a slow scrape
+        self.failed_scene_updates = []  # (scene id, error) for every scene update Stash rejected
+        self.scene_updates_in_flight = 0  # Batches taken off pending_scene_updates that Stash hasn't answered yet
+        self.scene_updates_sent = 0
+        self.scene_updates_skipped = 0  # Updates dropped because they wouldn't have changed anything
+        self.planned = {'performers': {}, 'studios': {}, 'tags': {}}  # Lookup key -> entity created in the plan, so later scenes find it instead of planning it again
+        self.session = self.createSession()
         self.setAuth()
         self.checkVersion()
-        self.populatePerformers()
-        self.populateTags()
-        self.populateStudios()
+        self.startup_time = time.perf_counter() - start
+        logging.debug("Connected to Stash in {:.3f}s".format(self.startup_time))
+
+    @property
+    def performers(self):
+        if self._performers is None:
+            self.loadCollections('performers', allow_server_lookup=False)  # Asked for the whole list, so load it even in server lookup mode
+        return self._performers
+
+    @performers.setter
+    def performers(self, performers):
+        self._performers = performers
+
+    @property
+    def studios(self):
+        if self._studios is None:
+            self.loadCollections('studios', allow_server_lookup=False)  # Asked for the whole list, so load it even in server lookup mode
+        return self._studios
+
+    @studios.setter
+    def studios(self, studios):
+        self._studios = studios
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self.loadCollections('tags', allow_server_lookup=False)  # Asked for the whole list, so load it even in server lookup mode
+        return self._tags
+
+    @tags.setter
+    def tags(self, tags):
+        self._tags = tags
+
+    def loadCollections(self, *collections, use_snapshot=True, allow_server_lookup=True):  # Loads any of 'performers', 'studios' and 'tags' (default all) that aren't loaded yet, fetching them concurrently
+        populate = {'performers': self.populatePerformers, 'studios': self.populateStudios, 'tags': self.populateTags}
+
+        def load(collection):
+            if allow_server_lookup and self.serverLookup(collection):
+                return
+            start = time.perf_counter()
+            populate[collection](use_snapshot)
+            self.load_times[collection] = time.perf_counter() - start
+            logging.debug("Loaded {} from Stash in {:.3f}s".format(collection, self.load_times[collection]))
+
+        with self.load_lock:
+            missing = [collection for collection in (collections or populate) if getattr(self, '_' + collection) is None]
+            if len(missing) > 1:
+                with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                    list(executor.map(load, missing))
+            elif missing:
+                load(missing[0])
+
+    def createSession(self):  # One pooled session is shared by every request to Stash, so connections (and TLS) are reused between calls
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({name: value for name, value in self.headers.items() if name != 'Content-Type'})  # GraphQL posts get theirs from json=, and the /login form post must not be labelled JSON
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        session.verify = not self.ignore_ssl_warnings
+        return session
+
+    def close(self):
+        self.flushSceneUpdates()
+        self.session.close()
 
     def setProxies(self, proxies):
         self.proxies = proxies
 
     def setAuth(self):
-        r = requests.get(self.server + "/playground", verify=not self.ignore_ssl_warnings)
+        r = self.session.get(self.server + "/playground", timeout=self.timeout)
         if len(r.history) > 0 and r.history[-1].status_code == 302:
             self.http_auth_type = "jwt"
             self.jwtAuth()
@@ -106,34 +395,33 @@ class stash_interface:
             self.http_auth_type = "none"
         else:
             self.http_auth_type = "basic"
+            self.session.auth = (self.username, self.password)
         return
 
     def jwtAuth(self):
-        response = requests.post(self.server + "/login", data={'username': self.username, 'password': self.password}, verify=not self.ignore_ssl_warnings)
+        response = self.session.post(self.server + "/login", data={'username': self.username, 'password': self.password}, timeout=self.timeout)
         self.auth_token = response.cookies.get('session', None)
         if not self.auth_token:
             logging.error("Error authenticating with Stash.  Double check your IP, Port, Username, and Password", exc_info=self.debug_mode)
             sys.exit()
 
     # GraphQL Functions
-    def callGraphQL(self, query, variables=None):
+    def callGraphQL(self, query, variables=None, timeout=None):
         if "mutation" in query:
             self.waitForIdle()  # Check that the DB is not locked
-        return self.__callGraphQL(query, variables)
+        result = self.__callGraphQL(query, variables, timeout=timeout)
+        if "mutation metadata" in query:  # We just queued a job, so Stash is no longer idle
+            self.idle_checked = None
+        return result
 
-    def __callGraphQL(self, query, variables, retry=True):
+    def __callGraphQL(self, query, variables, retry=True, timeout=None):
         graphql_server = self.server + "/graphql"
         json = {'query': query}
         if variables:
             json['variables'] = variables
 
         try:
-            if self.http_auth_type == "basic":
-                response = requests.post(graphql_server, json=json, headers=self.headers, auth=(self.username, self.password), verify=not self.ignore_ssl_warnings)
-            elif self.http_auth_type == "jwt":
-                response = requests.post(graphql_server, json=json, headers=self.headers, cookies={'session': self.auth_token}, verify=not self.ignore_ssl_warnings)
-            else:
-                response = requests.post(graphql_server, json=json, headers=self.headers, verify=not self.ignore_ssl_warnings)
+            response = self.session.post(graphql_server, json=json, timeout=timeout or self.timeout)
 
             if response.status_code == 200:
                 result = response.json()
@@ -144,7 +432,7 @@ class stash_interface:
                     return result
             elif retry and response.status_code == 401 and self.http_auth_type == "jwt":
                 self.jwtAuth()
-                return self.__callGraphQL(query, variables, False)
+                return self.__callGraphQL(query, variables, False, timeout)
             else:
                 logging.error("GraphQL query failed to run by returning code of {}. Query: {}.  Variables: {}".format(response.status_code, query, variables), exc_info=self.debug_mode)
                 raise Exception("GraphQL error")
@@ -152,18 +440,65 @@ class stash_interface:
             proceed = input("Caught certificate error trying to talk to Stash. Add ignore_ssl_warnings=True to your configuration.py to ignore permanently. Ignore for now? (yes/no):")
             if proceed == 'y' or proceed == 'Y' or proceed == 'Yes' or proceed == 'yes':
                 self.ignore_ssl_warnings = True
+                self.session.verify = False
                 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-                return self.callGraphQL(query, variables)
+                return self.callGraphQL(query, variables, timeout)
             else:
                 print("Exiting.")
                 sys.exit()
 
-    def waitForIdle(self):
-        jobQueue = self.getQueue()
-        if jobQueue:  # Check that the queue is empty
-            print("Stash is busy.  Retrying in 10 seconds.  Status:" + jobQueue[0]['description'] + "; Progress:" + '{:.0%}'.format(jobQueue[0].get('progress', 'N/A')))
-            time.sleep(10)
-            self.waitForIdle()
+    def waitForIdle(self, force=False):  # Returns once Stash's job queue is empty.  A recent idle result is reused for idle_ttl seconds unless force is set
+        with self.idle_lock:
+            if not force and self.idle_checked is not None and time.monotonic() - self.idle_checked < self.idle_ttl:
+                return
+            delay = self.idle_backoff
+            busy_since = None
+            while True:
+                jobQueue = self.getQueue()
+                self.idle_queue_checks = self.idle_queue_checks + 1
+                if not jobQueue:  # Check that the queue is empty
+                    break
+                if busy_since is None:
+                    busy_since = time.monotonic()
+                progress = jobQueue[0].get('progress', None)
+                print("Stash is busy.  Retrying in " + str(delay) + " seconds.  Status:" + jobQueue[0]['description'] + "; Progress:" + ('{:.0%}'.format(progress) if progress is not None else 'N/A'))
+                if not (self.use_job_subscription and self.__waitForJobChange(delay)):
+                    time.sleep(delay)
+                delay = min(delay * 2, self.idle_backoff_max)
+            if busy_since is not None:
+                self.idle_wait_time = self.idle_wait_time + time.monotonic() - busy_since
+            self.idle_checked = time.monotonic()
+
+    def __waitForJobChange(self, timeout):  # Waits up to timeout seconds for Stash to report a job finishing.  Returns False if the subscription can't be used
+        if websocket is None:
+            logging.warning("use_job_subscription needs the websocket-client package.  Falling back to polling")
+            self.use_job_subscription = False
+            return False
+        headers = []
+        if self.session.auth:
+            headers.append("Authorization: Basic " + base64.b64encode(":".join(self.session.auth).encode()).decode())
+        cookies = "; ".join("{}={}".format(name, value) for name, value in self.session.cookies.items())
+        connection = None
+        try:
+            deadline = time.monotonic() + timeout
+            connection = websocket.create_connection(re.sub(r'^http', 'ws', self.server) + "/graphql", timeout=timeout, header=headers, cookie=cookies or None, subprotocols=["graphql-ws"], sslopt={"cert_reqs": 0} if self.ignore_ssl_warnings else None)
+            connection.send(json.dumps({'type': 'connection_init', 'payload': {}}))
+            connection.send(json.dumps({'id': '1', 'type': 'start', 'payload': {'query': "subscription { jobsSubscribe { type } }"}}))
+            while time.monotonic() < deadline:
+                connection.settimeout(max(deadline - time.monotonic(), 0.1))
+                message = json.loads(connection.recv())
+                if message.get('type') == 'data' and message['payload']['data']['jobsSubscribe']['type'] == 'REMOVE':
+                    return True
+            return True
+        except websocket.WebSocketTimeoutException:
+            return True
+        except:
+            logging.warning("Couldn't subscribe to Stash's job queue.  Falling back to polling", exc_info=self.debug_mode)
+            self.use_job_subscription = False
+            return False
+        finally:
+            if connection:
+                connection.close()
 
     def getQueue(self):
         query = """
@@ -257,7 +592,9 @@ class stash_interface:
             logging.error("Your Stash version appears too low to use this script.  Please upgrade to the latest \"development\" build and try again.", exc_info=self.debug_mode)
             sys.exit()
 
-    def populatePerformers(self):
+    def populatePerformers(self, use_snapshot=True):
+        if use_snapshot and self.loadSnapshot('performers'):
+            return
         query = """
     {
         allPerformers
@@ -266,18 +603,45 @@ class stash_interface:
         name
         aliases
         image_path
+        updated_at
       }
     }
     """
         result = self.callGraphQL(query)
         stashPerformers = result["data"]["allPerformers"]
         for performer in stashPerformers:
-            if isinstance(performer['aliases'], str):
-                performer['aliases'] = [alias.strip() for alias in performer['aliases'].split(',')]  # Convert comma delimited string to list
+            self.__splitPerformerAliases(performer)
 
         self.performers = stashPerformers
+        self.indexPerformers()
+        self.saveSnapshot('performers')
 
-    def populateStudios(self):
+    @staticmethod
+    def __splitPerformerAliases(performer):
+        if isinstance(performer.get('aliases', None), str):
+            performer['aliases'] = [alias.strip() for alias in performer['aliases'].split(',')]  # Convert comma delimited string to list
+
+    def indexPerformers(self):  # Rebuilds the name/alias lookups.  The first performer in list order wins a key, same as a linear scan would
+        name_index = {}
+        alias_index = {}
+        for performer in self.performers:
+            self.__indexPerformer(performer, name_index, alias_index)
+        self.performer_name_index, self.performer_alias_index = name_index, alias_index  # Swapped in whole, so other threads never see a half built index
+
+    def __indexPerformer(self, performer, name_index=None, alias_index=None):
+        name_index = self.performer_name_index if name_index is None else name_index
+        alias_index = self.performer_alias_index if alias_index is None else alias_index
+        name = performer['name'].lower()
+        name_index.setdefault(name, performer)
+        alias_index.setdefault(name, performer)
+        if keyIsSet(performer, "aliases"):
+            for alias in performer["aliases"]:
+                if isinstance(alias, str):
+                    alias_index.setdefault(alias.lower(), performer)
+
+    def populateStudios(self, use_snapshot=True):
+        if use_snapshot and self.loadSnapshot('studios'):
+            return self.studios
         query = """
     {
         allStudios
@@ -287,15 +651,34 @@ class stash_interface:
         url
         image_path
         aliases
+        updated_at
       }
     }
     """
         result = self.callGraphQL(query)
         stashStudios = result["data"]["allStudios"]
         self.studios = stashStudios
+        self.indexStudios()
+        self.saveSnapshot('studios')
         return self.studios
 
-    def populateTags(self):
+    @staticmethod
+    def studioKey(name):  # Studio names match ignoring case, spaces, dashes, commas and apostrophes
+        return name.replace(' ', '').replace('-', '').replace(',', '').replace('\'', '').lower().strip()
+
+    def indexStudios(self):
+        studio_index = {}
+        for studio in self.studios:
+            self.__indexStudio(studio, studio_index)
+        self.studio_index = studio_index
+
+    def __indexStudio(self, studio, studio_index=None):
+        studio_index = self.studio_index if studio_index is None else studio_index
+        studio_index.setdefault(self.studioKey(studio['name']), studio)  # First studio in list order wins, same as a linear scan
+
+    def populateTags(self, use_snapshot=True):
+        if use_snapshot and self.loadSnapshot('tags'):
+            return
         query = """
     {
         allTags
@@ -303,44 +686,124 @@ class stash_interface:
         id
         name
         aliases
+        updated_at
       }
     }
     """
         result = self.callGraphQL(query)
         stashTags = result["data"]["allTags"]
         self.tags = stashTags
+        self.indexTags()
+        self.saveSnapshot('tags')
 
-    def findScenes(self, **kwargs):
-        stashScenes = []
-        variables = {}
-        max_scenes = kwargs.get("max_scenes", None)
-        accepted_variables = {'filter': 'FindFilterType!', 'scene_filter': 'SceneFilterType!', 'scene_ids': '[Int!]'}
+    @staticmethod
+    def tagKey(name):  # Tag names match ignoring case, spaces, dashes and parentheses
+        return name.lower().replace('-', ' ').replace('(', '').replace(')', '').strip().replace(' ', '')
 
-        variables['filter'] = {}  # Add filter to support pages, if necessary
+    def indexTags(self):
+        tag_index = {}
+        for tag in self.tags:
+            self.__indexTag(tag, tag_index)
+        self.tag_index = tag_index
+
+    def __indexTag(self, tag, tag_index=None):  # First tag in list order wins a key, whether by name or alias, same as a linear scan.  __findTag uses the same rule
+        tag_index = self.tag_index if tag_index is None else tag_index
+        tag_index.setdefault(self.tagKey(tag['name']), tag)
+        for alias in tag.get('aliases', None) or []:
+            tag_index.setdefault(self.tagKey(alias), tag)
+
+    def resync(self):  # Full refetch of our cached performers, studios and tags
+        self.cache_updates = 0
+        with self.load_lock:
+            self._performers = self._studios = self._tags = None
+            for collection in self.lookup_cache:
+                self.forgetLookups(collection)
+            self.loadCollections(use_snapshot=False)
 
-        # Add accepted variables to our passsed variables
-        for index, (accepted_variable, variable_type) in enumerate(accepted_variables.items()):
-            if accepted_variable in kwargs:
-                variables[accepted_variable] = kwargs[accepted_variable]
+    @staticmethod
+    def __parseTimestamp(timestamp):
+        return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+    def snapshotPath(self, collection):  # One file per collection per Stash server
+        return Path(self.snapshot_dir) / "{}-{}.pickle".format(hashlib.sha1(self.server.encode()).hexdigest()[:16], collection)
+
+    def saveSnapshot(self, collection):
+        if not self.snapshot_dir:
+            return
+        items = getattr(self, '_' + collection)
+        timestamps = [item['updated_at'] for item in items if item.get('updated_at', None)]
+        snapshot = {
+            'version': self.snapshot_version,
+            'server': self.server,
+            'updated_at': max(timestamps, key=self.__parseTimestamp) if timestamps else None,  # Stash's own clock, so our clock being off doesn't matter
+            'items': items,
+            'indexes': {index: getattr(self, index) for index in self.snapshot_collections[collection][5]}  # Pickled together with items, so the indexes still point at the same objects
+        }
+        path = self.snapshotPath(collection)
+        try:
+            path.parent.mkdir(exist_ok=True)
+            temp_path = path.with_suffix('.tmp' + str(os.getpid()))
+            with open(temp_path, 'wb') as snapshot_file:
+                pickle.dump(snapshot, snapshot_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)  # Readers never see a half-written snapshot
+        except:
+            logging.warning("Couldn't save the local snapshot of " + collection, exc_info=self.debug_mode)
 
-        # Set page and per_page, if not set
-        variables['filter'] = variables.get('filter', {})
-        variables['filter']['page'] = variables['filter'].get('page', 1)
-        if max_scenes:
-            variables['filter']['per_page'] = variables['filter'].get('per_page', min(100, max_scenes))
+    def loadSnapshot(self, collection):  # Loads collection from its snapshot plus whatever changed in Stash since.  Returns False if a full load is needed instead
+        if not self.snapshot_dir:
+            return False
+        all_query, find_query, filter_argument, filter_type, fields, indexes = self.snapshot_collections[collection]
+        try:
+            with open(self.snapshotPath(collection), 'rb') as snapshot_file:
+                snapshot = pickle.load(snapshot_file)
+            if snapshot.get('version', None) != self.snapshot_version or snapshot.get('server', None) != self.server or not snapshot.get('updated_at', None):
+                return False
+
+            # Anything updated in the second of our newest entity or later, plus the current total so we can spot deletions
+            since = (self.__parseTimestamp(snapshot['updated_at']) - timedelta(seconds=1)).isoformat()
+            query = "query($filter: " + filter_type + ") {changed: " + find_query + "(" + filter_argument + ": $filter, filter: {per_page: -1}) {" + collection + " {" + fields + "}} total: " + find_query + "(filter: {per_page: 1}) {count}}"
+            result = self.callGraphQL(query, {'filter': {'updated_at': {'value': since, 'modifier': 'GREATER_THAN'}}})
+            changed = result["data"]["changed"][collection]
+            total = result["data"]["total"]["count"]
+        except FileNotFoundError:
+            return False
+        except:
+            logging.warning("Couldn't refresh the local snapshot of " + collection + ".  Doing a full load", exc_info=self.debug_mode)
+            return False
+
+        if collection == 'performers':
+            for performer in changed:
+                self.__splitPerformerAliases(performer)
+        snapshot_by_id = {item['id']: item for item in snapshot['items']}
+        changed = [item for item in changed if snapshot_by_id.get(item['id'], None) != item]  # The one-second overlap re-sends some entities we already have
+        changed_by_id = {item['id']: item for item in changed}
+        items = [changed_by_id.pop(item['id'], item) for item in snapshot['items']] + list(changed_by_id.values())  # Updated entities keep their place, new ones go at the end
+        if len(items) != total:  # Something was deleted since the snapshot
+            try:
+                result = self.callGraphQL("{" + all_query + " {id}}")
+                current_ids = {item['id'] for item in result["data"][all_query]}
+            except:
+                return False
+            items = [item for item in items if item['id'] in current_ids]
+            if len(items) != total:
+                return False
+
+        setattr(self, '_' + collection, items)
+        if len(changed) == 0 and len(items) == len(snapshot['items']):
+            for index in indexes:
+                setattr(self, index, snapshot['indexes'][index])
         else:
-            variables['filter']['per_page'] = variables['filter'].get('per_page', 100)
+            {'performers': self.indexPerformers, 'studios': self.indexStudios, 'tags': self.indexTags}[collection]()
+            self.saveSnapshot(collection)
+        logging.debug("Loaded {} from the local snapshot with {} changes".format(collection, len(changed)))
+        return True
 
-        # Build our query string (e.g., "findScenes(filter:FindFilterType!){" )
-        query_string = "query(" + ", ".join(":".join(("$" + str(k), accepted_variables[k])) for k, v in variables.items()) + '){'
-
-        # Build our findScenes string
-        findScenes_string = "findScenes(" + ", ".join(":".join((str(k), "$" + str(k))) for k, v in variables.items()) + '){'
+    def __cacheUpdated(self):  # Called after every local cache splice; triggers a full resync every resync_every updates
+        self.cache_updates = self.cache_updates + 1
+        if self.resync_every and self.cache_updates >= self.resync_every:
+            self.resync()
 
-        try:
-            query = query_string + findScenes_string + """
-                count
-                scenes{
+    scene_fields = """
                   id
                   title
                   oshash
@@ -376,27 +839,122 @@ class stash_interface:
                         id
                         aliases
                     }
+                  paths
+                    {
+                        screenshot
+                    }
+    """
+    scene_phash = False  # If True, scenes also come with their phash.  Only set this for Stash versions that generate phashes
+    scene_page_size = 100  # Largest page of full scenes requested by iterScenes
+    scene_first_page_size = 20  # iterScenes starts small so the first scenes arrive quickly, then grows pages while they stay fast
+    scene_page_time = 2.0  # Target seconds per page of full scenes; iterScenes grows or shrinks pages around this
+    scene_id_page_size = 1000
+    scene_prefetch = 2  # Number of pages iterScenes fetches ahead of the scene being consumed
+
+    @staticmethod
+    def __findScenesQuery(variables, fields):
+        accepted_variables = {'filter': 'FindFilterType!', 'scene_filter': 'SceneFilterType!', 'scene_ids': '[Int!]'}
+
+        # Build our query string (e.g., "findScenes(filter:FindFilterType!){" )
+        query_string = "query(" + ", ".join(":".join(("$" + str(k), accepted_variables[k])) for k, v in variables.items()) + '){'
+
+        # Build our findScenes string
+        findScenes_string = "findScenes(" + ", ".join(":".join((str(k), "$" + str(k))) for k, v in variables.items()) + '){'
+
+        return query_string + findScenes_string + """
+                count
+                scenes{
+                """ + fields + """
                 }
               }
             }
             """
-            result = self.callGraphQL(query, variables)
 
-            stashScenes = result["data"]["findScenes"]["scenes"]
-            if not max_scenes:
-                max_scenes = result["data"]["findScenes"]["count"]
-            total_pages = math.ceil(max_scenes / variables['filter']['per_page'])
-            print("Getting Stash Scenes Page: " + str(variables['filter']['page']) + " of " + str(total_pages))
-            if variables['filter']['page'] < total_pages and len(stashScenes) < max_scenes:  # If we're not at the last page or max_scenes, recurse with page +1
-                variables['filter']['page'] = variables['filter']['page'] + 1
-                stashScenes = stashScenes + self.findScenes(**variables)
+    def findSceneIds(self, **kwargs):  # Returns the ids of all matching scenes, in order.  Takes the same arguments as findScenes
+        variables = {}
+        max_scenes = kwargs.get("max_scenes", None)
+        for accepted_variable in ('filter', 'scene_filter', 'scene_ids'):
+            if accepted_variable in kwargs:
+                variables[accepted_variable] = kwargs[accepted_variable]
+        variables['filter'] = dict(variables.get('filter', {}))
+        variables['filter']['page'] = 1
+        variables['filter']['per_page'] = min(self.scene_id_page_size, max_scenes) if max_scenes else self.scene_id_page_size
+        query = self.__findScenesQuery(variables, "id")
+
+        def getPage(page):
+            page_variables = dict(variables, filter=dict(variables['filter'], page=page))
+            return self.callGraphQL(query, page_variables)["data"]["findScenes"]
+
+        result = getPage(1)
+        scene_ids = [scene['id'] for scene in result["scenes"]]
+        total = min(result["count"], max_scenes) if max_scenes else result["count"]
+        total_pages = math.ceil(total / variables['filter']['per_page'])
+        if total_pages > 1:  # We know how many pages there are now, so fetch the rest concurrently
+            with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+                for page in executor.map(getPage, range(2, total_pages + 1)):
+                    scene_ids = scene_ids + [scene['id'] for scene in page["scenes"]]
+        return scene_ids[:total]
+
+    def iterScenesById(self, scene_ids, prefetch=None):  # Yields full scenes for scene_ids in the given order, fetching pages ahead of the consumer
+        prefetch = prefetch or self.scene_prefetch
+        query = self.__findScenesQuery({'filter': None, 'scene_ids': None}, self.scene_fields + ("phash\n" if self.scene_phash else ""))
+        page_size = min(self.scene_first_page_size, self.scene_page_size)
+
+        def getPage(page_ids):
+            start = time.perf_counter()
+            variables = {'filter': {'per_page': len(page_ids)}, 'scene_ids': [int(scene_id) for scene_id in page_ids]}
+            scenes = self.callGraphQL(query, variables)["data"]["findScenes"]["scenes"]
+            position = {scene_id: index for index, scene_id in enumerate(page_ids)}
+            scenes.sort(key=lambda scene: position.get(scene['id'], len(position)))  # Keep the order of scene_ids regardless of Stash's sort
+            return scenes, time.perf_counter() - start
+
+        offset = 0
+        page_number = 0
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            while offset < len(scene_ids) or pending:
+                while offset < len(scene_ids) and len(pending) < prefetch:
+                    pending.append(executor.submit(getPage, scene_ids[offset:offset + page_size]))
+                    offset = offset + page_size
+                scenes, elapsed = pending.popleft().result()
+                page_number = page_number + 1
+                print("Getting Stash Scenes Page: " + str(page_number) + " (" + str(min(offset, len(scene_ids))) + " of " + str(len(scene_ids)) + " scenes requested)")
+                if elapsed < self.scene_page_time / 2:  # Adapt the size of pages we haven't requested yet
+                    page_size = min(page_size * 2, self.scene_page_size)
+                elif elapsed > self.scene_page_time * 2:
+                    page_size = max(page_size // 2, 1)
+                for scene in scenes:
+                    yield scene
+
+    def iterScenes(self, prefetch=None, **kwargs):  # Streaming findScenes.  The matching ids are snapshotted first, so scenes we update while iterating can't shift later pages
+        scene_ids = self.findSceneIds(**kwargs)
+        return self.iterScenesById(scene_ids, prefetch)
 
+    def findScenes(self, **kwargs):
+        stashScenes = []
+        try:
+            for scene in self.iterScenes(**kwargs):
+                stashScenes.append(scene)
         except:
             logging.error("Unexpected error getting stash scene:", exc_info=self.debug_mode)
 
         return stashScenes
 
-    def updateSceneData(self, scene_data):
+    def updateSceneData(self, scene_data, original=None):  # Pass the scene as Stash returned it as original to send only the fields that changed.  Queues the update when batching is enabled; call flushSceneUpdates when done
+        if original is not None:
+            scene_data = self.diffSceneUpdateData(self.createSceneUpdateData(original), scene_data)
+            if scene_data is None:
+                with self.scene_update_lock:
+                    self.scene_updates_skipped = self.scene_updates_skipped + 1
+                return
+        with self.scene_update_lock:
+            self.scene_updates_sent = self.scene_updates_sent + 1
+        if self.plan is not None:
+            self.plan.write('sceneUpdate', scene_data)
+            return
+        if self.scene_batch_size > 1:
+            self.queueSceneUpdate(scene_data)
+            return
         query = """
     mutation sceneUpdate($input:SceneUpdateInput!) {
       sceneUpdate(input: $input){
@@ -408,8 +966,77 @@ class stash_interface:
         variables = {'input': scene_data}
         result = self.callGraphQL(query, variables)
 
+    def queueSceneUpdate(self, scene_data):
+        with self.scene_update_lock:
+            if not self.pending_scene_updates:
+                self.pending_scene_updates_since = time.monotonic()
+                self.scene_batch_timer = threading.Timer(self.scene_batch_seconds, self.flushSceneUpdates)
+                self.scene_batch_timer.daemon = True
+                self.scene_batch_timer.start()
+            self.pending_scene_updates.append(scene_data)
+            full = len(self.pending_scene_updates) >= self.scene_batch_size
+            stale = time.monotonic() - self.pending_scene_updates_since >= self.scene_batch_seconds
+        if full or stale:
+            self.flushSceneUpdates()
+
+    def flushSceneUpdates(self):  # Sends all pending scene updates as one aliased mutation.  Returns a list of (scene id, error) for updates that failed
+        with self.scene_update_lock:
+            batch = self.pending_scene_updates
+            self.pending_scene_updates = []
+            self.pending_scene_updates_since = None
+            timer = self.scene_batch_timer
+            self.scene_batch_timer = None
+            if batch:
+                self.scene_updates_in_flight = self.scene_updates_in_flight + 1
+        if timer is not None:
+            timer.cancel()
+        if not batch:
+            return []
+
+        # Mutation fields run in order, so repeated updates to the same scene still apply in the order they were queued
+        query = "mutation sceneUpdates(" + ", ".join("$s{}:SceneUpdateInput!".format(index) for index in range(len(batch))) + ") {\n"
+        query = query + "\n".join("  s{0}: sceneUpdate(input: $s{0}){{ id }}".format(index) for index in range(len(batch))) + "\n}"
+        variables = {"s" + str(index): scene_data for index, scene_data in enumerate(batch)}
+
+        failed = []
+        try:
+            result = self.callGraphQL(query, variables) or {}
+            data = result.get("data") or {}
+            errors = {}
+            for error in result.get("errors") or []:
+                errors.setdefault((error.get("path") or [None])[0], error.get("message", error))
+            for index, scene_data in enumerate(batch):
+                alias = "s" + str(index)
+                if not data.get(alias):
+                    failed.append((scene_data.get('id'), errors.get(alias, "no result returned")))
+        except:
+            logging.error("Unexpected error sending scene updates:", exc_info=self.debug_mode)
+            failed = [(scene_data.get('id'), "request failed") for scene_data in batch]
+
+        for scene_id, error in failed:
+            logging.error("Failed to update scene " + str(scene_id) + ": " + str(error))
+        with self.scene_update_lock:
+            self.failed_scene_updates.extend(failed)
+            self.scene_updates_in_flight = self.scene_updates_in_flight - 1
+        return failed
+
+    def sceneCoverMatches(self, scene, image):  # True if Stash already has image (JPEG bytes) as the cover of scene, as returned by findScenes
+        screenshot = (scene.get('paths', None) or {}).get('screenshot', None)
+        if not screenshot:
+            return False
+        try:
+            response = self.session.get(screenshot, proxies=self.proxies, timeout=self.timeout)
+            return response.status_code == 200 and response.content == image
+        except:
+            logging.debug("Couldn't fetch the current cover of scene " + str(scene.get('id', None)), exc_info=self.debug_mode)
+            return False
+
     def addPerformer(self, performer_data):
         result = None
+        if self.plan is not None:
+            performer = {'name': performer_data['name'], 'aliases': list(performer_data.get('aliases', None) or []), 'image_path': None}
+            return self.__planCreate('performers', 'performerCreate', performer_data, performer, [performer['name'].lower()] + listToLower(performer['aliases']))
+        self.loadCollections('performers')  # Load before creating, so the new performer isn't both fetched and spliced in
         update_data = performer_data
         if update_data.get('aliases', None):
             update_data['aliases'] = ', '.join(update_data['aliases'])
@@ -417,7 +1044,10 @@ class stash_interface:
         query = """
     mutation performerCreate($input:PerformerCreateInput!) {
       performerCreate(input: $input){
-        id 
+        id
+        name
+        aliases
+        image_path
       }
     }
     """
@@ -425,26 +1055,35 @@ class stash_interface:
 
         try:
             result = self.callGraphQL(query, variables)
-            self.populatePerformers()
-            return result["data"]["performerCreate"]["id"]
+            new_performer = dict(result["data"]["performerCreate"])
+            self.__splitPerformerAliases(new_performer)
+            if self._performers is not None:
+                self.performers.append(new_performer)
+                self.__indexPerformer(new_performer)
+            self.forgetLookups('performers', misses_only=True)
+            self.__cacheUpdated()
+            return new_performer["id"]
         except:
             logging.error("Error in adding performer", exc_info=self.debug_mode)
             logging.error(variables)
             logging.error(result)
 
     def getPerformerImage(self, url):  # UNTESTED
-        if self.http_auth_type == "basic":
-            return base64.b64encode(requests.get(url, proxies=self.proxies, auth=HTTPBasicAuth(self.username, self.password), verify=not self.ignore_ssl_warnings).content)
-        elif self.http_auth_type == "jwt":
-            return base64.b64encode(requests.get(url, proxies=self.proxies, headers=self.headers, cookies={'session': self.auth_token}, verify=not self.ignore_ssl_warnings).content)
-        else:
-            return base64.b64encode(requests.get(url, proxies=self.proxies, verify=not self.ignore_ssl_warnings).content)
+        return base64.b64encode(self.session.get(url, proxies=self.proxies, timeout=self.timeout).content)
 
     def addStudio(self, studio_data):
+        if self.plan is not None:
+            studio = {'name': studio_data['name'], 'url': studio_data.get('url', None), 'image_path': None, 'aliases': studio_data.get('aliases', None) or []}
+            return self.__planCreate('studios', 'studioCreate', studio_data, studio, [self.studioKey(studio['name'])])
+        self.loadCollections('studios')  # Load before creating, so the new studio isn't both fetched and spliced in
         query = """
         mutation studioCreate($input:StudioCreateInput!) {
           studioCreate(input: $input){
-            id       
+            id
+            name
+            url
+            image_path
+            aliases
           }
         }
         """
@@ -452,17 +1091,29 @@ class stash_interface:
         variables = {'input': studio_data}
         try:
             result = self.callGraphQL(query, variables)
-            self.populateStudios()
-            return result["data"]["studioCreate"]["id"]
+            new_studio = dict(result["data"]["studioCreate"])
+            if self._studios is not None:
+                self.studios.append(new_studio)
+                self.__indexStudio(new_studio)
+            self.forgetLookups('studios', misses_only=True)
+            self.__cacheUpdated()
+            return new_studio["id"]
         except:
             logging.error("Error in adding studio:", exc_info=self.debug_mode)
             logging.error(variables)
 
     def updateStudio(self, studio_data):
+        if self.plan is not None:
+            self.plan.write('studioUpdate', studio_data)
+            return
         query = """
         mutation studioUpdate($input:StudioUpdateInput!) {
           studioUpdate(input: $input){
             id
+            name
+            url
+            image_path
+            aliases
           }
         }
         """
@@ -470,15 +1121,29 @@ class stash_interface:
         variables = {'input': studio_data}
         try:
             result = self.callGraphQL(query, variables)
+            updated_studio = result["data"]["studioUpdate"]
+            if updated_studio:  # Swap the refreshed studio into our cache; a rename can change which studio a name maps to
+                updated_studio = dict(updated_studio)
+                if self._studios is not None:
+                    self.studios = [updated_studio if studio['id'] == updated_studio['id'] else studio for studio in self.studios]
+                    self.indexStudios()
+                self.forgetLookups('studios')
+                self.__cacheUpdated()
         except:
             logging.error("Error in updating studio:", exc_info=self.debug_mode)
             logging.error(variables)
 
     def addTag(self, tag_data):
+        if self.plan is not None:
+            tag = {'name': tag_data['name'], 'aliases': tag_data.get('aliases', None) or []}
+            return self.__planCreate('tags', 'tagCreate', tag_data, tag, [self.tagKey(tag['name'])])
+        self.loadCollections('tags')  # Load before creating, so the new tag isn't both fetched and spliced in
         query = """
         mutation tagCreate($input:TagCreateInput!) {
           tagCreate(input: $input){
-            id       
+            id
+            name
+            aliases
           }
         }
         """
@@ -486,16 +1151,22 @@ class stash_interface:
 
         try:
             result = self.callGraphQL(query, variables)
-            self.populateTags()
-            return result["data"]["tagCreate"]["id"]
+            new_tag = dict(result["data"]["tagCreate"])
+            new_tag['aliases'] = new_tag.get('aliases', None) or []
+            if self._tags is not None:
+                self.tags.append(new_tag)
+                self.__indexTag(new_tag)
+            self.forgetLookups('tags', misses_only=True)
+            self.__cacheUpdated()
+            return new_tag["id"]
         except:
             logging.error("Error in adding tags", exc_info=self.debug_mode)
             logging.error(variables)
 
     def deleteTagByName(self, name):
-        tag_data = {'id': self.getTagByName(name)}
-        if tag_data['id']:
-            return self.deleteTag(tag_data)
+        tag = self.getTagByName(name)
+        if tag:
+            return self.deleteTag(tag)
         return False
 
     def deleteTagByID(self, tag_id):
@@ -516,7 +1187,11 @@ class stash_interface:
 
         try:
             result = self.callGraphQL(query, variables)
-            self.populateTags()
+            if self._tags is not None:
+                self.tags = [tag for tag in self.tags if tag['id'] != tag_data['id']]
+                self.indexTags()  # Rebuild, since the deleted tag may have shadowed another tag's name or alias
+            self.forgetLookups('tags')
+            self.__cacheUpdated()
             return result["data"]["tagDestroy"]
         except:
             logging.error("Error in deleting tag", exc_info=self.debug_mode)
@@ -534,7 +1209,11 @@ class stash_interface:
 
         try:
             result = self.callGraphQL(query, variables)
-            self.populateTags()
+            if self._performers is not None:
+                self.performers = [performer for performer in self.performers if performer['id'] != performer_data['id']]
+                self.indexPerformers()
+            self.forgetLookups('performers')
+            self.__cacheUpdated()
             return result["data"]["performerDestroy"]
         except:
             logging.error("Error in deleting performer", exc_info=self.debug_mode)
@@ -552,13 +1231,15 @@ class stash_interface:
 
         try:
             result = self.callGraphQL(query, variables)
-            self.populateTags()
             return result["data"]["sceneDestroy"]
         except:
             logging.error("Error in deleting scene", exc_info=self.debug_mode)
             logging.error(variables)
 
     def updatePerformer(self, performer_data):
+        if self.plan is not None:
+            self.plan.write('performerUpdate', performer_data)
+            return performer_data
         update_data = performer_data
         if update_data.get('aliases', None):
             update_data['aliases'] = ', '.join(update_data['aliases'])
@@ -577,6 +1258,15 @@ class stash_interface:
     """
         variables = {'input': update_data}
         result = self.callGraphQL(query, variables)
+        updated_performer = result["data"]["performerUpdate"]
+        if updated_performer:  # Swap the refreshed performer into our cache so lookups see the new name/aliases
+            updated_performer = dict(updated_performer)
+            self.__splitPerformerAliases(updated_performer)
+            if self._performers is not None:
+                self.performers = [updated_performer if performer['id'] == updated_performer['id'] else performer for performer in self.performers]
+                self.indexPerformers()
+            self.forgetLookups('performers')
+            self.__cacheUpdated()
         return result["data"]["performerUpdate"]
 
     def scrapePerformerFreeones(self, name):
@@ -605,61 +1295,252 @@ class stash_interface:
             logging.error("Error in scraping Freeones", exc_info=self.debug_mode)
             logging.error(variables)
 
-    def __getPerformerByName(self, name, check_aliases=False):  # A private function that allows disabling of checking for aliases
+    def __planCreate(self, collection, op, data, entity, keys):  # Plans a creation and makes the planned entity findable by name.  Returns its placeholder id
+        with self.create_lock:
+            entity['id'] = self.plan.write(op, copy.deepcopy(data), collection)
+            for key in keys:
+                self.planned[collection].setdefault(key, entity)
+        return entity['id']
 
-        for performer in self.performers:
-            if performer['name'].lower() == name:  # Check input name against performer name
+    @staticmethod
+    def __resolveRefs(value, refs):  # Swaps placeholder ids for the ids applyPlan created.  Placeholders whose creation failed are dropped
+        if isinstance(value, dict):
+            return {key: stash_interface.__resolveRefs(item, refs) for key, item in value.items() if not (isPlanned(item) and refs.get(item, None) is None)}
+        if isinstance(value, list):
+            return [stash_interface.__resolveRefs(item, refs) for item in value if not (isPlanned(item) and refs.get(item, None) is None)]
+        if isPlanned(value):
+            return refs.get(value, None)
+        return value
+
+    def applyPlan(self, path):  # Sends the changes in a scene_plan file, in order.  Planned entities that Stash has by now are reused rather than created again.  Returns the number of changes applied per operation
+        refs = {}  # placeholder id -> created id
+        applied = {}
+        scene_batch_size = self.scene_batch_size
+        self.scene_batch_size = max(scene_batch_size, self.plan_batch_size)
+        try:
+            with open(str(path), encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # Cut short by a crash
+                        logging.error("Skipping unreadable line in plan: " + line.strip()[:100])
+                        continue
+                    op = entry['op']
+                    data = self.__resolveRefs(entry['input'], refs)
+                    try:
+                        if op == 'performerCreate':
+                            existing = self.getPerformerByName(data['name'])
+                            result = refs[entry['ref']] = existing['id'] if existing else self.addPerformer(data)
+                        elif op == 'studioCreate':
+                            existing = self.getStudioByName(data['name'])
+                            result = refs[entry['ref']] = existing['id'] if existing else self.addStudio(data)
+                        elif op == 'tagCreate':
+                            existing = self.getTagByName(data['name'])
+                            result = refs[entry['ref']] = existing['id'] if existing else self.addTag(data)
+                        elif op == 'performerUpdate':
+                            result = self.updatePerformer(data)
+                        elif op == 'studioUpdate':
+                            result = self.updateStudio(data) or True
+                        elif op == 'sceneUpdate':
+                            result = self.updateSceneData(data) or True  # Queued; failures are reported by flushSceneUpdates
+                        else:
+                            logging.error("Unknown operation in plan: " + str(op))
+                            continue
+                    except:
+                        logging.error("Error applying " + str(op) + " from plan:", exc_info=self.debug_mode)
+                        continue
+                    if result:
+                        applied[op] = applied.get(op, 0) + 1
+            self.flushSceneUpdates()
+        finally:
+            self.scene_batch_size = scene_batch_size
+        return applied
+
+    def serverLookup(self, collection):  # True if names in collection are looked up in Stash as needed, rather than in a loaded list
+        if getattr(self, '_' + collection) is not None or self.lookup_mode == "local":
+            return False
+        if self.lookup_mode == "server":
+            return True
+        with self.lookup_lock:
+            if collection not in self.server_lookups:
+                find_query = self.snapshot_collections[collection][1]
+                result = self.callGraphQL("{" + find_query + "(filter: {per_page: 1}) {count}}")
+                count = result["data"][find_query]["count"]
+                self.server_lookups[collection] = count > self.server_lookup_threshold
+                if self.server_lookups[collection]:
+                    logging.debug("Stash has {} {}.  Looking them up as needed instead of loading them".format(count, collection))
+        return self.server_lookups[collection]
+
+    def __cachedLookup(self, collection, key, lookup):  # LRU cache in front of server lookups.  Misses are cached too
+        cache = self.lookup_cache[collection]
+        with self.lookup_lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+        result = lookup()
+        with self.lookup_lock:
+            cache[key] = result
+            if len(cache) > self.lookup_cache_size:
+                cache.popitem(last=False)
+        return result
+
+    def forgetLookups(self, collection, misses_only=False):  # Called when we change collection in Stash.  A new entity can only turn misses into hits
+        with self.lookup_lock:
+            cache = self.lookup_cache[collection]
+            for key in [key for key, value in cache.items() if value is None or not misses_only]:
+                del cache[key]
+
+    @staticmethod
+    def __keyRegex(key, ignored):  # Case insensitive regex for any name that normalizes to key by dropping the ignored characters
+        gap = "[" + ignored + "]*"
+        return "(?i)^" + gap + gap.join(re.escape(character) for character in key) + gap + "$"
+
+    def __findPerformers(self, name, check_aliases):
+        performer_filter = {'name': {'value': name, 'modifier': 'EQUALS'}}
+        if check_aliases:
+            performer_filter['OR'] = {'aliases': {'value': name, 'modifier': 'INCLUDES'}}
+        query = """
+    query($performer_filter: PerformerFilterType) {
+      findPerformers(performer_filter: $performer_filter, filter: {per_page: -1}) {
+        performers {
+          id
+          name
+          aliases
+          image_path
+        }
+      }
+    }
+    """
+        result = self.callGraphQL(query, {'performer_filter': performer_filter})
+        for performer in result["data"]["findPerformers"]["performers"]:
+            self.__splitPerformerAliases(performer)
+            if performer['name'].lower() == name or (check_aliases and name in listToLower(performer.get('aliases', None) or [])):  # Stash's filters are looser than our matching
                 return performer
-            elif check_aliases and keyIsSet(performer, "aliases"):  # Check input name against performer aliases
-                performer_aliases_lower = listToLower(performer["aliases"])
-                if name in performer_aliases_lower:
-                    return performer
+        return None
+
+    def __findStudio(self, key):
+        query = """
+    query($studio_filter: StudioFilterType) {
+      findStudios(studio_filter: $studio_filter, filter: {per_page: -1}) {
+        studios {
+          id
+          name
+          url
+          image_path
+          aliases
+        }
+      }
+    }
+    """
+        result = self.callGraphQL(query, {'studio_filter': {'name': {'value': self.__keyRegex(key, " ,'\\-"), 'modifier': 'MATCHES_REGEX'}}})
+        for studio in result["data"]["findStudios"]["studios"]:
+            if self.studioKey(studio['name']) == key:
+                return studio
+        return None
+
+    def __findTag(self, key):
+        regex = {'value': self.__keyRegex(key, " ()\\-"), 'modifier': 'MATCHES_REGEX'}
+        query = """
+    query($tag_filter: TagFilterType) {
+      findTags(tag_filter: $tag_filter, filter: {per_page: -1}) {
+        tags {
+          id
+          name
+          aliases
+        }
+      }
+    }
+    """
+        result = self.callGraphQL(query, {'tag_filter': {'name': regex, 'OR': {'aliases': regex}}})
+        for tag in result["data"]["findTags"]["tags"]:  # First tag whose name or alias matches, same as the local index
+            if self.tagKey(tag['name']) == key or key in [self.tagKey(alias) for alias in tag.get('aliases', None) or []]:
+                return tag
+        return None
+
+    def __getPerformerByName(self, name, check_aliases=False):  # A private function that allows disabling of checking for aliases
+        if check_aliases:
+            return self.performer_alias_index.get(name, None)  # Check input name against performer names and aliases
+        return self.performer_name_index.get(name, None)  # Check input name against performer names only
 
     def getPerformerByName(self, name, aliases=[]):
+        server_lookup = self.serverLookup('performers')
+        if not server_lookup:
+            self.loadCollections('performers')
         name = name.lower()
         input_aliases_lower = listToLower(aliases)
 
-        result = self.__getPerformerByName(name, True)
+        if server_lookup:
+            result = self.__cachedLookup('performers', ('alias', name), lambda: self.__findPerformers(name, True))
+        else:
+            result = self.__getPerformerByName(name, True)
         if result:  # This matches input name with existing name or alias
             return result
 
         for input_alias in input_aliases_lower:  # For each alias, recurse w/ name = alias, but disable alias to alias mapping
-            result = self.__getPerformerByName(input_alias, False)
+            if server_lookup:
+                result = self.__cachedLookup('performers', ('name', input_alias), lambda: self.__findPerformers(input_alias, False))
+            else:
+                result = self.__getPerformerByName(input_alias, False)
             if result:
                 return result
 
+        for planned_name in [name] + input_aliases_lower:
+            if planned_name in self.planned['performers']:
+                return self.planned['performers'][planned_name]
         return None
 
     def getStudioByName(self, name):
-        for studio in self.studios:
-            if studio['name'].lower().strip() == name.lower().strip():
-                return studio
-            if studio['name'].replace(' ', '').replace('-', '').replace(',', '').replace('\'', '').lower().strip() == name.replace(' ', '').replace('-', '').replace(',', '').replace('\'', '').lower().strip():
-                return studio
-        return None
+        key = self.studioKey(name)
+        if self.serverLookup('studios'):
+            studio = self.__cachedLookup('studios', key, lambda: self.__findStudio(key))
+        else:
+            self.loadCollections('studios')
+            studio = self.studio_index.get(key, None)
+        return studio or self.planned['studios'].get(key, None)
 
     def getTagByName(self, name, add_tag_if_missing=False):
         logging.debug("Getting tag id for tag \'" + name + "\'.")
-        search_name = name.lower().replace('-', ' ').replace('(', '').replace(')', '').strip().replace(' ', '')
-        for tag in self.tags:
-            if search_name == tag['name'].lower().replace('-', ' ').replace('(', '').replace(')', '').strip().replace(' ', ''):
-                logging.debug("Found the tag.  ID is " + tag['id'])
-                return tag
-            else:
-                for alias in tag['aliases']:
-                    if search_name == alias.lower().replace('-', ' ').replace('(', '').replace(')', '').strip().replace(' ', ''):
-                        logging.debug("Found the tag.  ID is " + tag['id'])
-                        return tag
+        key = self.tagKey(name)
+        if self.serverLookup('tags'):
+            tag = self.__cachedLookup('tags', key, lambda: self.__findTag(key))
+        else:
+            self.loadCollections('tags')
+            tag = self.tag_index.get(key, None)
+        tag = tag or self.planned['tags'].get(key, None)
+        if tag:
+            logging.debug("Found the tag.  ID is " + tag['id'])
+            return tag
 
         # Add the Tag to Stash
         if add_tag_if_missing:
-            stash_tag = {"name": name}
-            print("Did not find " + name + " in Stash.  Adding Tag.")
-            self.addTag(stash_tag)
+            with self.create_lock:
+                tag = self.getTagByName(name)  # Check again, in case another thread added it while we waited
+                if tag:
+                    return tag
+                stash_tag = {"name": name}
+                print("Did not find " + name + " in Stash.  Adding Tag.")
+                self.addTag(stash_tag)
             return self.getTagByName(name)
 
         return None
 
+    @staticmethod
+    def diffSceneUpdateData(original_data, scene_data):  # Returns id plus the fields of scene_data that differ from original_data, or None if nothing differs.  Both are SceneUpdateInput dicts
+        diff = {'id': scene_data['id']}
+        for key, value in scene_data.items():
+            original_value = original_data.get(key, None)
+            if key in ('performer_ids', 'tag_ids', 'gallery_ids'):  # Order doesn't matter for these
+                changed = set(value or []) != set(original_value or [])
+            elif key == 'movies':
+                changed = sorted((movie['movie_id'], movie.get('scene_index', None) or 0) for movie in value or []) != sorted((movie['movie_id'], movie.get('scene_index', None) or 0) for movie in original_value or [])
+            else:
+                changed = value != original_value
+            if changed:
+                diff[key] = value
+        if len(diff) == 1:
+            return None
+        return diff
+
     @staticmethod
     def createSceneUpdateData(scene_data):  # Scene data returned from stash has a different format than what is accepted by the UpdateScene graphQL query.  This converts one format to another
         scene_update_data = {}
@@ -790,6 +1671,10 @@ def parseArgs(args):
                            '--wait',
                            action='store_true',
                            help='wait for idle before completing')
+    my_parser.add_argument('-t',
+                           '--timing',
+                           action='store_true',
+                           help='print how long it took to connect to Stash and load its data')
     my_parser.add_argument('-at',
                            '--auto_tag',
                            nargs='?',
@@ -825,6 +1710,8 @@ def main(args):
             server = 'http://' + str(config.server_ip) + ':' + str(config.server_port)
 
         my_stash = stash_interface(server, config.username, config.password, config.ignore_ssl_warnings)
+        if args.timing:
+            print("Connected to Stash in {:.3f}s".format(my_stash.startup_time))
         if args.scan:
             if args.path:
                 print("Scanning {}".format(','.join(args.path)))
@@ -854,6 +1741,10 @@ def main(args):
             my_stash.autoTag()
         if args.wait:
             my_stash.waitForIdle()
+        if args.timing:
+            for collection, load_time in my_stash.load_times.items():
+                print("Loaded {} in {:.3f}s".format(collection, load_time))
+            print("Waited {:.1f}s for Stash to go idle ({} job queue checks)".format(my_stash.idle_wait_time, my_stash.idle_queue_checks))
         print("Success! Finished.")
 
     except: